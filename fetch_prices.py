@@ -1,42 +1,64 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import os, json, math, time
+import os, json, math, time, threading
+from functools import lru_cache, wraps
+from collections import namedtuple
 from datetime import datetime, timezone, timedelta
 import pandas as pd
 import numpy as np
-import yfinance as yf
-import urllib.request
-import urllib.parse
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import orjson  # あれば高速な JSON パーサを使う
+except ImportError:
+    orjson = None
 
 JST = timezone(timedelta(hours=9))
+json_loads = orjson.loads if orjson else json.loads
 TD_KEY = os.environ.get("TWELVE_API_KEY", "").strip()
 
 BASE_TD = "https://api.twelvedata.com"
 
+# Twelve Data 用の keep-alive セッション（429/5xx は軽くリトライ）
+TD_SESSION = requests.Session()
+TD_SESSION.mount("https://", HTTPAdapter(
+    pool_maxsize=8,
+    max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504)),
+))
+
 def now_jst_str():
     return datetime.now(JST).strftime("%Y-%m-%d %H:%M:%S")
 
 def http_get(url, params=None, timeout=15):
-    if params:
-        url = url + "?" + urllib.parse.urlencode(params)
-    with urllib.request.urlopen(url, timeout=timeout) as r:
-        return r.read().decode("utf-8")
+    r = TD_SESSION.get(url, params=params, timeout=timeout)
+    r.raise_for_status()
+    return r.content  # bytes のまま返し、decode は JSON パーサに任せる
 
-def td_price(symbol):
+def td_prices(symbols):
     """
-    Twelve Data: quote で最新値と時刻
-    返り値: (price(float|None), iso_time(str|None))
+    Twelve Data: quote で最新値と時刻（複数シンボルを 1 リクエストにまとめる）
+    返り値: {symbol: (price(float|None), iso_time(str|None))}
     """
+    out = {sym: (None, None) for sym in symbols}
     if not TD_KEY:
-        return None, None
+        return out
     try:
-        txt = http_get(f"{BASE_TD}/quote", {"symbol": symbol, "apikey": TD_KEY})
-        j = json.loads(txt)
-        p = float(j.get("price"))
-        t = j.get("datetime")  # ISO
-        return p, t
+        raw = http_get(f"{BASE_TD}/quote", {"symbol": ",".join(symbols), "apikey": TD_KEY})
+        j = json_loads(raw)
     except Exception:
-        return None, None
+        return out
+    for sym in symbols:
+        # 複数指定時はシンボルをキーにした辞書で返ってくる
+        q = j.get(sym) if len(symbols) > 1 else j
+        try:
+            p = float(q.get("price"))
+            t = q.get("datetime")  # ISO
+            out[sym] = (p, t)
+        except Exception:
+            pass
+    return out
 
 def td_series(symbol, interval="5min", outputsize=120):
     """
@@ -46,36 +68,63 @@ def td_series(symbol, interval="5min", outputsize=120):
     if not TD_KEY:
         return None
     try:
-        txt = http_get(f"{BASE_TD}/time_series", {
+        raw = http_get(f"{BASE_TD}/time_series", {
             "symbol": symbol,
             "interval": interval,
             "outputsize": outputsize,
             "orderby": "asc",
             "apikey": TD_KEY
         })
-        j = json.loads(txt)
+        j = json_loads(raw)
         if "values" not in j:  # エラー時は "message" 等
             return None
-        rows = []
-        for v in j["values"]:
-            dt = datetime.fromisoformat(v["datetime"].replace("Z","+00:00")).astimezone(JST)
-            rows.append((dt, float(v["close"])))
-        if not rows:
+        values = j["values"]
+        if not values:
             return None
-        idx = [r[0] for r in rows]
-        vals = [r[1] for r in rows]
+        # 時刻はまとめて変換（タイムゾーン無しの値は UTC とみなす）
+        idx = pd.to_datetime([v["datetime"] for v in values], utc=True).tz_convert(JST)
+        vals = np.fromiter((float(v["close"]) for v in values), dtype=np.float64, count=len(values))
         return pd.Series(vals, index=idx, name=symbol)
     except Exception:
         return None
 
+def _cached_once(fn):
+    """
+    lru_cache と同じくメモ化するが、同じ引数での同時呼び出しはロックで待たせ、
+    実際の取得は 1 回だけにする（run_parallel のスレッドから呼ばれるため）
+    """
+    cached = lru_cache(maxsize=None)(fn)
+    guard = threading.Lock()
+    locks = {}
+
+    @wraps(fn)
+    def wrapper(*args):
+        with guard:
+            lock = locks.setdefault(args, threading.Lock())
+        with lock:
+            return cached(*args)
+    return wrapper
+
+@_cached_once
+def _ticker(sym: str):
+    # Ticker は crumb/cookie 等の状態を持つので銘柄ごとに使い回す
+    # yfinance の import は重いので、最初に使うワーカースレッド内で行い HTTP 待ちと重ねる
+    import yfinance as yf
+    return yf.Ticker(sym)
+
+@_cached_once
+def _history(sym: str, period: str, interval: str):
+    # 同一実行内では (銘柄, 期間, 足) ごとに 1 回だけ取得する
+    return _ticker(sym).history(period=period, interval=interval)
+
 def yf_last_price_smart(ticker: str):
     """
     yfinance で『できるだけ今に近い』価格を取得（主に 1540.T 用）
-      1m->5m->15m->fast_info->1d
+      1m(5日分)->fast_info->1d
     """
     def hist_last(period, interval):
         try:
-            h = yf.Ticker(ticker).history(period=period, interval=interval)
+            h = _history(ticker, period, interval)
             if h is not None and len(h)>0:
                 close = h["Close"].dropna()
                 if len(close)>0:
@@ -90,95 +139,157 @@ def yf_last_price_smart(ticker: str):
             pass
         return None, None
 
-    p, ts = hist_last("1d","1m")
-    if p is not None: return p, ts
-    p, ts = hist_last("5d","5m")
-    if p is not None: return p, ts
-    p, ts = hist_last("60d","15m")
+    # 1m 足を 5 日分まとめて取れば、5m/15m 足の最終値も同じバーになるので追加の取得は不要
+    # （休場日をまたいでも直近の場の最終バーが取れる）
+    p, ts = hist_last("5d","1m")
     if p is not None: return p, ts
     try:
-        fi = yf.Ticker(ticker).fast_info or {}
-        lp = fi.get("last_price")
-        if lp and math.isfinite(lp):
+        lp = _ticker(ticker).fast_info.last_price
+        if lp is not None and math.isfinite(lp) and lp > 0:
             return float(lp), "fast_info"
     except Exception:
         pass
-    p, ts = hist_last("5d","1d")
+    # 日足は day モードと同じ期間にして取得結果を共有する
+    p, ts = hist_last("1mo","1d")
     if p is not None: return p, ts
     return None, None
 
 def yf_series_close(ticker: str, period: str, interval: str):
     try:
-        s = yf.Ticker(ticker).history(period=period, interval=interval)["Close"].dropna()
+        s = _history(ticker, period, interval)["Close"].dropna()
         return s
     except Exception:
         return None
 
+def daily_close(s: pd.Series):
+    """
+    分足を東証の大引け（15:30 JST）時点の値で日足に集約（index は JST の 0 時）
+    Twelve Data のバーは開始時刻ラベルなので、15:15 のバーの終値が 15:30 の値
+    """
+    if s is None:
+        return None
+    d = s.between_time("00:00", "15:15").resample("1D").last().dropna()
+    return d if len(d)>0 else None
+
+class AlignedData(namedtuple("AlignedData", "xau jpy etf index")):
+    """align_join の結果。各列は同じ長さの float64 配列、index は対応する時刻"""
+    __slots__ = ()
+
+    def tail(self, n):
+        return AlignedData(self.xau[-n:], self.jpy[-n:], self.etf[-n:], self.index[-n:])
+
 def align_join(x: pd.Series, j: pd.Series, e: pd.Series, tail=None):
     if x is None or j is None or e is None:
         return None
-    df = pd.concat([x.rename("xau"), j.rename("jpy"), e.rename("etf")], axis=1).dropna()
-    if tail: df = df.tail(tail)
-    df = df[np.isfinite(df).all(1)]
-    return df if len(df)>0 else None
-
-def estimate_k(df: pd.DataFrame):
-    if df is None or len(df) < 5: return None
-    X = df["xau"] * df["jpy"]
-    Y = df["etf"]
-    num = float((X*Y).sum()); den = float((X*X).sum())
+    # 共通の時刻だけを取り出してから並べる（concat の外部結合を避ける）
+    idx = x.index.intersection(j.index).intersection(e.index)
+    # float64 の連続バッファにしておけば isfinite は ufunc の SIMD ループ 1 回で済む
+    arr = np.ascontiguousarray(
+        np.column_stack([x.reindex(idx).to_numpy(), j.reindex(idx).to_numpy(), e.reindex(idx).to_numpy()]),
+        dtype=np.float64)
+    # NaN と ±inf を 1 回の isfinite でまとめて除外（dropna は不要）
+    mask = np.isfinite(arr).all(axis=1)
+    # 列ごとに連続した配列（SoA）で持つ。下流は estimate_k と tail だけなので DataFrame は作らない
+    cols = arr[mask].T.copy()
+    a = AlignedData(cols[0], cols[1], cols[2], idx[mask])
+    if tail: a = a.tail(tail)
+    return a if a.etf.size>0 else None
+
+def _k_kernel(x: np.ndarray, j: np.ndarray, e: np.ndarray):
+    """
+    原点を通る回帰 e ≈ k * (x*j) の係数 k（配列のみで計算）
+    den <= 0 のときは None
+    """
+    p = x * j
+    num = float(np.dot(p, e)); den = float(np.dot(p, p))
     if den <= 0: return None
     return num/den
 
+def estimate_k(a: AlignedData, min_rows=5):
+    if a is None or a.etf.size < min_rows: return None
+    return _k_kernel(a.xau, a.jpy, a.etf)
+
+def run_parallel(tasks, max_workers=8):
+    """
+    互いに独立な取得処理をスレッドで同時に実行
+    tasks: {name: callable}
+    返り値: {name: 結果}（例外を出したタスクは None）
+    """
+    def safe(fn):
+        try:
+            return fn()
+        except Exception:
+            return None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        futs = {name: ex.submit(safe, fn) for name, fn in tasks.items()}
+        return {name: f.result() for name, f in futs.items()}
+
 def main():
-    # --- live prices from Twelve Data (gold & fx) ---
+    # --- HTTP 取得はすべて独立なので同時に投げる ---
     # Twelve Data のシンボルは "XAU/USD", "USD/JPY"
-    xauusd, t_xau = td_price("XAU/USD")
-    usdjpy, t_jpy = td_price("USD/JPY")
+    r = run_parallel({
+        "quote": lambda: td_prices(("XAU/USD","USD/JPY")),
+        "etf":   lambda: yf_last_price_smart("1540.T"),
+        # 1540 の日足は yfinance（XAU/USD, USD/JPY の日足は15分足から作る）
+        "e_day": lambda: yf_series_close("1540.T","1mo","1d"),
+        # 5分足（XAU/USDとUSD/JPYは Twelve Data、1540はyfinance）
+        "x_5":   lambda: td_series("XAU/USD","5min",200),     # だいたい過去16時間分
+        "j_5":   lambda: td_series("USD/JPY","5min",200),
+        "e_5":   lambda: yf_series_close("1540.T","5d","5m"), # 東証場中のみ更新が基本
+        # 15分足（日足用に約2週間分）
+        "x_15":  lambda: td_series("XAU/USD","15min",1000),
+        "j_15":  lambda: td_series("USD/JPY","15min",1000),
+        "e_15":  lambda: yf_series_close("1540.T","60d","15m"),
+    })
+
+    # --- live prices from Twelve Data (gold & fx) ---
+    quote = r["quote"] or {}
+    xauusd, t_xau = quote.get("XAU/USD", (None, None))
+    usdjpy, t_jpy = quote.get("USD/JPY", (None, None))
 
     # フォールバック（キー未設定/失敗時）
+    # 5分足の直近バーをそのまま使う（別途リクエストしない）
     if xauusd is None or usdjpy is None:
-        # 最低限、直近バーを取る
-        x5 = td_series("XAU/USD","5min",5)
-        j5 = td_series("USD/JPY","5min",5)
-        if x5 is not None: xauusd = float(x5.dropna().iloc[-1]); t_xau = str(x5.dropna().index[-1])
-        if j5 is not None: usdjpy = float(j5.dropna().iloc[-1]); t_jpy = str(j5.dropna().index[-1])
+        x5 = r["x_5"].dropna() if r["x_5"] is not None else None
+        j5 = r["j_5"].dropna() if r["j_5"] is not None else None
+        if xauusd is None and x5 is not None and len(x5)>0:
+            xauusd = float(x5.iloc[-1]); t_xau = str(x5.index[-1])
+        if usdjpy is None and j5 is not None and len(j5)>0:
+            usdjpy = float(j5.iloc[-1]); t_jpy = str(j5.index[-1])
 
     # --- 1540.T from Yahoo ---
-    price1540, t_etf = yf_last_price_smart("1540.T")
+    price1540, t_etf = r["etf"] or (None, None)
 
     # --- day mode (3営業日・日足) ---
-    # 日足は yfinance（1540に合わせて東証のバーと整合を取りやすい）
-    x_day = yf_series_close("XAUUSD=X","1mo","1d")
-    j_day = yf_series_close("JPY=X","1mo","1d")
-    e_day = yf_series_close("1540.T","1mo","1d")
+    # XAU/USD, USD/JPY は24時間取引なので、15分足から 1540 の大引けと同じ時刻の値を日足とする
+    x_day = daily_close(r["x_15"])
+    j_day = daily_close(r["j_15"])
+    e_day = r["e_day"]
     df_day = align_join(x_day, j_day, e_day, tail=10)
     k_day = theo_day = dev_day = None
     if df_day is not None:
-        k_day = estimate_k(df_day.tail(3))
+        k_day = estimate_k(df_day.tail(3), min_rows=3)  # 日足は3営業日で回帰
 
-    # --- 5分足（XAU/USDとUSD/JPYは Twelve Data、1540はyfinance） ---
-    x_5 = td_series("XAU/USD","5min",200)     # だいたい過去16時間分
-    j_5 = td_series("USD/JPY","5min",200)
-    e_5 = yf_series_close("1540.T","5d","5m") # 東証場中のみ更新が基本
+    # --- 5分足 ---
+    x_5, j_5, e_5 = r["x_5"], r["j_5"], r["e_5"]
     df_5 = align_join(x_5, j_5, e_5)
     k_5m = theo_5m = dev_5m = None
     if df_5 is not None:
         k_5m = estimate_k(df_5.tail(36))      # 直近約3時間
 
     # --- 15分足 ---
-    x_15 = td_series("XAU/USD","15min",200)
-    j_15 = td_series("USD/JPY","15min",200)
-    e_15 = yf_series_close("1540.T","60d","15m")
+    x_15, j_15, e_15 = r["x_15"], r["j_15"], r["e_15"]
     df_15 = align_join(x_15, j_15, e_15)
     k_15m = theo_15m = dev_15m = None
     if df_15 is not None:
         k_15m = estimate_k(df_15.tail(32))    # 直近約8時間
 
     # --- 理論値＆乖離計算（各モード） ---
+    spot = xauusd * usdjpy if (xauusd and usdjpy) else None
     def calc(the_k):
-        if the_k and xauusd and usdjpy and price1540:
-            theo = xauusd * usdjpy * the_k
+        if the_k and spot and price1540:
+            theo = spot * the_k
             return theo, (price1540/theo - 1.0)
         return None, None
 
@@ -203,8 +314,12 @@ def main():
     if usdjpy and (usdjpy < 50 or usdjpy > 500): warn.append("USD/JPY out of range?")
     if warn: out["warnings"] = warn
 
-    with open("data.json","w",encoding="utf-8") as f:
-        json.dump(out, f, ensure_ascii=False, indent=2)
+    if orjson:
+        with open("data.json","wb") as f:
+            f.write(orjson.dumps(out, option=orjson.OPT_INDENT_2))
+    else:
+        with open("data.json","w",encoding="utf-8") as f:
+            json.dump(out, f, ensure_ascii=False, indent=2)
 
 if __name__ == "__main__":
     main()